@@ -1,25 +1,31 @@
 import os
+import re
+import functools
+import logging
 import tempfile
+from bisect import bisect_left, bisect_right
 from datetime import datetime
 import pandas as pd
 import unicodedata
 from tkinter import Tk, Frame, Label, Button, Entry, StringVar, OptionMenu, LEFT, RIGHT, BOTH, X
 from tkinter import messagebox, Listbox, Scrollbar, Toplevel
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-from reportlab.lib.utils import simpleSplit
-from PIL import Image, ImageTk
-import fitz  # PyMuPDF
-import io
+# reportlab, PyMuPDF (fitz) et PIL.ImageTk sont importés à la demande
+# pour accélérer le démarrage de l'application.
+from PIL import Image
+
+log = logging.getLogger(__name__)
 
 # ----------------- Configuration -----------------
 EMPLOYEES_FILE = 'lll.CSV'
+EMPLOYEES_CHUNKSIZE = 50_000
 LOGO_PATH = 'logo.jpg'
 LOGO = 'logo.png'
 STAMP_PATH = 'cachet.png'
 OUTPUT_PDF = 'lettre_liaison.pdf'
+PREVIEW_MAX_XREFS = 500  # taille max du document d'aperçu réutilisé avant réouverture
 BASE_FILE = 'Base_LettreLiaison.xlsx'
+BASE_CSV = 'Base_LettreLiaison.csv'  # lignes ajoutées en attente d'export vers BASE_FILE
+BASE_KEY_COLUMNS = ['Matricule', 'Date d\'admission']
 BASE_COLUMNS = ['Matricule', 'Nom & Prénom', 'CIN', 'CNSS', 'Date d\'admission', 'Lieu d\'admission', 'Type de prise en charge']
 
 HOSPITAUX = {
@@ -37,24 +43,54 @@ ENTREPRISE_INFO = {
 }
 
 # ----------------- Helpers -----------------
+@functools.lru_cache(maxsize=1)
+def _get_fitz():
+    """Importe PyMuPDF au premier aperçu seulement (import coûteux)."""
+    import fitz  # PyMuPDF
+    return fitz
+
+# Table de correspondance pour les lettres accentuées courantes (noms français)
+_ACCENT_TABLE = str.maketrans(
+    'àáâãäåçèéêëìíîïñòóôõöùúûüýÿÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜÝ',
+    'aaaaaaceeeeiiiinooooouuuuyyAAAAAACEEEEIIIINOOOOOUUUUY'
+)
+
+# Diacritiques combinants (blocs Unicode des marques combinantes)
+_COMBINING_PATTERN = '[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]'
+_COMBINING_RE = re.compile(_COMBINING_PATTERN)
+
 def remove_accents(text: str) -> str:
+    """
+    Supprime les accents : table de correspondance, puis NFKD sans les marques combinantes.
+    Les lettres sans décomposition (œ, æ, ø, ß) sont conservées.
+    """
     if not isinstance(text, str):
         text = str(text)
-    nfkd = unicodedata.normalize('NFKD', text)
-    return ''.join([c for c in nfkd if not unicodedata.combining(c)])
-
-def deduplicate_columns(columns):
-    """Ajoute .1, .2, etc. aux colonnes dupliquées pour les rendre uniques."""
-    seen = {}
-    new_cols = []
-    for col in columns:
-        if col not in seen:
-            seen[col] = 0
-            new_cols.append(col)
-        else:
-            seen[col] += 1
-            new_cols.append(f"{col}.{seen[col]}")
-    return new_cols
+    # Chemin rapide : la plupart des valeurs (Matricule, CIN, CNSS...) sont en ASCII
+    try:
+        text.encode('ascii')
+        return text
+    except UnicodeEncodeError:
+        pass
+    text = text.translate(_ACCENT_TABLE)
+    if text.isascii():
+        return text
+    return _COMBINING_RE.sub('', unicodedata.normalize('NFKD', text))
+
+def normalize_name(text: str) -> str:
+    """Forme de recherche d'un nom : minuscules, sans accents (voir remove_accents)."""
+    return remove_accents(str(text).lower()).strip()
+
+def normalize_name_column(s: pd.Series) -> pd.Series:
+    """Version vectorisée de normalize_name : mêmes étapes que remove_accents, colonne par colonne"""
+    return (s.str.lower().str.translate(_ACCENT_TABLE).str.normalize('NFKD')
+            .str.replace(_COMBINING_PATTERN, '', regex=True).str.strip())
+
+def prefix_matches(sorted_values, prefix, limit=20):
+    """Renvoie au plus `limit` valeurs d'une liste triée qui commencent par `prefix`."""
+    lo = bisect_left(sorted_values, prefix)
+    hi = bisect_right(sorted_values, prefix + '\uffff')
+    return sorted_values[lo:min(hi, lo + limit)]
 
 def format_cin(cin):
     """Formate le CIN sur 8 chiffres, en ajoutant des zéros au début si nécessaire"""
@@ -63,53 +99,61 @@ def format_cin(cin):
     s = ''.join(ch for ch in str(cin) if ch.isdigit())
     return s.zfill(8)
 
-def format_num(num):
-    """Formate la clé Num sur 2 chiffres"""
-    if pd.isna(num) or str(num).strip() == '':
-        return ''
-    s = ''.join(ch for ch in str(num) if ch.isdigit())
-    return s.zfill(2)
+def format_digits_column(s: pd.Series, width: int) -> pd.Series:
+    """
+    Garde les chiffres d'une colonne et les complète à `width` avec des zéros (cellules vides conservées).
+    Ex. CIN sur 8 chiffres (comme format_cin), clé Num sur 2 chiffres.
+    """
+    s = s.astype('string').fillna('')
+    digits = s.str.replace(r'\D', '', regex=True).str.zfill(width)
+    return digits.where(s.str.strip() != '', '')
 
-def clean_csv_value(val):
+CSV_FORMULA_PATTERN = r'^="(.*)"$'
+
+def clean_csv_columns(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Supprime ="" autour des valeurs et espace inutile.
+    Supprime ="" autour des valeurs et espace inutile, colonne par colonne.
     Exemple : '="230065"' -> '230065'
     """
-    if pd.isna(val):
-        return ''
-    val = str(val).strip()
-    if val.startswith('="') and val.endswith('"'):
-        val = val[2:-1]  # supprime ="
-    return val.strip()
+    for col in df.columns:
+        s = df[col]
+        # Les colonnes Arrow gardent leurs opérations .str natives (regex RE2)
+        if not isinstance(s.dtype, pd.ArrowDtype):
+            s = s.astype('string')
+        s = s.str.strip()
+        df[col] = s.str.replace(CSV_FORMULA_PATTERN, r'\1', regex=True).str.strip().fillna('')
+    return df
+
+def map_employee_column(col):
+    """Renvoie le nom de colonne normalisé pour un en-tête du fichier, ou None s'il n'est pas utilisé."""
+    key = remove_accents(col).strip().lower()
+    if 'matric' in key:
+        return 'Matricule'
+    elif 'prenom' in key or 'prénom' in key:
+        return 'Prénom'
+    elif 'nom' in key:
+        return 'Nom'
+    elif 'carte de sejour' in key or 'carte de travail' in key:
+        return 'CIN'
+    elif 'numéro de securite' in key or 'numero de securite' in key:
+        return 'CNSS'
+    elif 'clé du numéro de securite' in key or 'cle du numero de securite' in key:
+        return 'Num'
+    return None
 
 def normalize_employee_columns(df: pd.DataFrame) -> pd.DataFrame:
-    print("\n[DEBUG] Colonnes brutes depuis le fichier :", list(df.columns))
-    df.columns = deduplicate_columns(df.columns)
-    print("[DEBUG] Colonnes après déduplication :", list(df.columns))
+    # read_csv rend déjà les en-têtes dupliqués uniques (Nom, Nom.1, ...)
+    log.debug("Colonnes brutes depuis le fichier : %s", list(df.columns))
 
-    mapping = {}
-    for col in df.columns:
-        key = remove_accents(col).strip().lower()
-        if 'matric' in key:
-            mapping[col] = 'Matricule'
-        elif 'prenom' in key or 'prénom' in key:
-            mapping[col] = 'Prénom'
-        elif 'nom' in key:
-            mapping[col] = 'Nom'
-        elif 'carte de sejour' in key or 'carte de travail' in key:
-            mapping[col] = 'CIN'
-        elif 'numéro de securite' in key or 'numero de securite' in key:
-            mapping[col] = 'CNSS'
-        elif 'clé du numéro de securite' in key or 'cle du numero de securite' in key:
-            mapping[col] = 'Num'
-
-
-    print("[DEBUG] Mapping appliqué :", mapping)
-
-    df = df.rename(columns=mapping)
-    # Supprimer les colonnes dupliquées restantes
-    df = df.loc[:, ~df.columns.duplicated()]
-    print("[DEBUG] Colonnes après renommage et déduplication :", list(df.columns))
+    mapping = {col: map_employee_column(col) for col in df.columns}
+    # Première colonne du fichier retenue pour chaque colonne cible
+    sources = {target: col for col, target in reversed(mapping.items()) if target}
+    log.debug("Mapping appliqué : %s", sources)
+
+    # Sélection et renommage en une passe : plus de colonnes dupliquées
+    keep = [col for col in df.columns if mapping[col] and sources[mapping[col]] == col]
+    df = df[keep].rename(columns=mapping)
+    log.debug("Colonnes après renommage et déduplication : %s", list(df.columns))
 
     # Ajouter les colonnes manquantes
     for needed in ['Matricule', 'Nom', 'Prénom', 'CIN', 'CNSS', 'Num']:
@@ -129,49 +173,123 @@ def update_cnss_with_num(df):
     if 'Num' not in df.columns:
         df['Num'] = ''
 
-    df['Num'] = df['Num'].apply(format_num)
-    df['CNSS'] = df['CNSS'].astype(str).str.strip() + df['Num']
-    df['CNSS'] = df['CNSS'].apply(lambda x: x if len(x) >= 8 else '')
+    df['Num'] = format_digits_column(df['Num'], 2)
+    cnss = df['CNSS'].astype('string').fillna('').str.strip() + df['Num']
+    df['CNSS'] = cnss.where(cnss.str.len() >= 8, '')
 
     return df
 
 # ----------------- Main Loader -----------------
+def read_employees_arrow():
+    """
+    Lit le fichier employés avec pyarrow (colonnes texte adossées à Arrow).
+    Renvoie None si pyarrow n'est pas installé ou ne sait pas lire le fichier
+    (ex. lignes incomplètes, que pandas complète) : le lecteur pandas prend le relais.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+    except ImportError:
+        return None
+
+    # En-têtes lus par pandas : mêmes noms dédoublonnés (Nom, Nom.1, ...) que read_csv
+    header = list(pd.read_csv(EMPLOYEES_FILE, sep=';', encoding='cp1252', nrows=0).columns)
+    used = [col for col in header if map_employee_column(col) is not None]
+    try:
+        tbl = pacsv.read_csv(
+            EMPLOYEES_FILE,
+            read_options=pacsv.ReadOptions(encoding='cp1252', column_names=header, skip_rows=1),
+            parse_options=pacsv.ParseOptions(delimiter=';'),
+            convert_options=pacsv.ConvertOptions(include_columns=used,
+                                                 column_types={col: pa.string() for col in used},
+                                                 strings_can_be_null=False)
+        )
+    except pa.ArrowInvalid as e:
+        log.debug("Lecture pyarrow impossible, lecture pandas : %s", e)
+        return None
+    return tbl.to_pandas(types_mapper=pd.ArrowDtype)
+
+def read_employees_chunked():
+    """Lit le fichier employés par blocs avec pandas (sans pyarrow)."""
+    chunks = []
+    with pd.read_csv(EMPLOYEES_FILE, sep=';', encoding='cp1252', engine='c',
+                     dtype=str, na_filter=False, chunksize=EMPLOYEES_CHUNKSIZE,
+                     usecols=lambda col: map_employee_column(col) is not None) as reader:
+        for chunk in reader:
+            # Nettoyer les cellules puis normaliser les colonnes du bloc
+            chunk = clean_csv_columns(chunk)
+            chunks.append(normalize_employee_columns(chunk))
+
+    if chunks:
+        return pd.concat(chunks, ignore_index=True)
+    return normalize_employee_columns(pd.DataFrame())
+
 def load_employees():
     if not os.path.exists(EMPLOYEES_FILE):
         raise FileNotFoundError(f"Fichier employés introuvable: {EMPLOYEES_FILE}")
-    
-    df = pd.read_csv(EMPLOYEES_FILE, sep=';', encoding='cp1252')
-    print("[DEBUG] Shape du fichier chargé :", df.shape)
-
-    # Nettoyer toutes les cellules du CSV
-    df = df.applymap(clean_csv_value)
 
-    # Normaliser les colonnes
-    df = normalize_employee_columns(df)
-    print("[DEBUG] Shape après normalisation :", df.shape)
+    # Tout est lu en texte : pas d'inférence de types ni de détection NaN,
+    # et les zéros de tête (CIN, clé CNSS) sont conservés.
+    # Seules les colonnes utilisées sont lues.
+    try:
+        df = read_employees_arrow()
+        if df is not None:
+            df = normalize_employee_columns(clean_csv_columns(df))
+        else:
+            df = read_employees_chunked()
+    except pd.errors.EmptyDataError:
+        # Fichier vide (0 octet) : aucun employé, mêmes colonnes qu'un fichier sans lignes
+        df = normalize_employee_columns(pd.DataFrame())
+    log.debug("Shape après normalisation : %s", df.shape)
 
     # Formater CIN
-    df['CIN'] = df['CIN'].apply(format_cin)
+    df['CIN'] = format_digits_column(df['CIN'], 8)
 
     # Concaténer CNSS + Num
     df = update_cnss_with_num(df)
-    print("[DEBUG] Quelques lignes après update CNSS :\n", df.head())
+    # df.head() passe par le formateur pandas : uniquement si le debug est actif
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Quelques lignes après update CNSS :\n%s", df.head())
 
     return df
 
 # ----------------- PDF Generation -----------------
-def generate_pdf(data, hospital_name, hospital_address):
-    c = canvas.Canvas(OUTPUT_PDF, pagesize=A4)
-    width, height = A4
-    margin = 20 * mm
+@functools.lru_cache(maxsize=None)
+def get_image_reader(path):
+    """Décode une image une seule fois par processus (None si le fichier est absent)."""
+    if not os.path.exists(path):
+        return None
+    from reportlab.lib.utils import ImageReader
+    return ImageReader(path)
+
+@functools.lru_cache(maxsize=None)
+def wrap_hospital_text(hospital_name, hospital_address, max_width):
+    """
+    Découpe une seule fois par hôpital les phrases fixes de la lettre (Helvetica 10).
+    Renvoie (lignes d'introduction, lignes du paragraphe principal).
+    """
+    from reportlab.lib.utils import simpleSplit
+    intro = [
+        f"La société {ENTREPRISE_INFO['name']} demande au {hospital_name} l’admission d’un patient affilié {ENTREPRISE_INFO['name']} :",
+        f"Lieu d'admission : {hospital_name}",
+        f"Adresse : {hospital_address}"
+    ]
+    paragraph = f"Prise en charge Totale par {ENTREPRISE_INFO['name']} : La facture du {hospital_name} est à régler totalement par {ENTREPRISE_INFO['name']}."
+    intro_lines = tuple(wline for line in intro for wline in simpleSplit(line, 'Helvetica', 10, max_width))
+    return intro_lines, tuple(simpleSplit(paragraph, 'Helvetica', 10, max_width))
+
+def draw_letterhead(c, width, height, margin):
+    """Dessine l'en-tête fixe de la lettre (logo, entreprise, titres)."""
+    from reportlab.lib.units import mm
     top_margin = 68 * mm
     logo_width = 40 * mm
 
     # Logo top-right
-    if os.path.exists(LOGO_PATH):
+    logo = get_image_reader(LOGO_PATH)
+    if logo is not None:
         x = width - margin - logo_width
         y = height - top_margin - logo_width
-        c.drawImage(LOGO_PATH, x, y, width=logo_width, preserveAspectRatio=True)
+        c.drawImage(logo, x, y, width=logo_width, preserveAspectRatio=True)
 
     # Company info left
     c.setFont('Helvetica-Bold', 10)
@@ -187,30 +305,45 @@ def generate_pdf(data, hospital_name, hospital_address):
     c.setFont('Helvetica-Bold', 12)
     c.drawCentredString(width/2, height - 80*mm, "ADMISSION D’UN PATIENT")
 
+def generate_pdf(data, hospital_name, hospital_address):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import simpleSplit
+
+    c = canvas.Canvas(OUTPUT_PDF, pagesize=A4)
+    width, height = A4
+    margin = 20 * mm
+
+    draw_letterhead(c, width, height, margin)
+
     today = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
     c.setFont('Helvetica', 10)
     c.drawString(margin, height - 95*mm, f"Date : {today}")
 
     # Corps du texte
     y = height - 105*mm
+    max_width = width - 2*margin
+    intro_lines, paragraph_lines = wrap_hospital_text(hospital_name, hospital_address, max_width)
+    # (texte, à découper) : seuls les identifiants courts tiennent toujours sur une ligne
     lines = [
-        f"La société {ENTREPRISE_INFO['name']} demande au {hospital_name} l’admission d’un patient affilié {ENTREPRISE_INFO['name']} :",
-        f"Lieu d'admission : {hospital_name}",
-        f"Adresse : {hospital_address}",
-        f"Matricule : {data.get('Matricule','')}",
-        f"Nom du patient : {data.get('Nom','')} {data.get('Prénom','')}",
-        "Nationalité : Tunisienne",
-        f"Numéro CIN : {data.get('CIN','')}",
-        f"CNSS : {data.get('CNSS','')}",
-        f"Médecin requérant : {data.get('MedecinRequerant','')}",
-        f"Médecin(s) traitant(s) : {data.get('MedecinTraitant','')}",
-        f"Date d'admission : {data.get('DateAdmission','')}",
-        f"Type de prise en charge : {data.get('TypePriseEnCharge','')}"
+        (f"Matricule : {data.get('Matricule','')}", False),
+        (f"Nom du patient : {data.get('Nom','')} {data.get('Prénom','')}", False),
+        ("Nationalité : Tunisienne", False),
+        (f"Numéro CIN : {data.get('CIN','')}", False),
+        (f"CNSS : {data.get('CNSS','')}", False),
+        (f"Médecin requérant : {data.get('MedecinRequerant','')}", True),
+        (f"Médecin(s) traitant(s) : {data.get('MedecinTraitant','')}", True),
+        (f"Date d'admission : {data.get('DateAdmission','')}", True),
+        (f"Type de prise en charge : {data.get('TypePriseEnCharge','')}", True)
     ]
 
     c.setFont('Helvetica', 10)
-    for line in lines:
-        wrapped = simpleSplit(line, 'Helvetica', 10, width - 2*margin)
+    for wline in intro_lines:
+        c.drawString(margin, y, wline)
+        y -= 6.5*mm
+    for line, wrap in lines:
+        wrapped = simpleSplit(line, 'Helvetica', 10, max_width) if wrap else (line,)
         for wline in wrapped:
             c.drawString(margin, y, wline)
             y -= 6.5*mm
@@ -219,9 +352,7 @@ def generate_pdf(data, hospital_name, hospital_address):
     y -= 6.5*mm
 
     # Paragraphe principal
-    paragraph = f"Prise en charge Totale par {ENTREPRISE_INFO['name']} : La facture du {hospital_name} est à régler totalement par {ENTREPRISE_INFO['name']}."
-    wrapped = simpleSplit(paragraph, 'Helvetica', 10, width - 2*margin)
-    for wline in wrapped:
+    for wline in paragraph_lines:
         c.drawString(margin, y, wline)
         y -= 6.5*mm
     y -= 20*mm
@@ -233,8 +364,9 @@ def generate_pdf(data, hospital_name, hospital_address):
     y -= 10*mm
 
     # Cachet
-    if os.path.exists(STAMP_PATH):
-        c.drawImage(STAMP_PATH, margin, 20*mm, width=40*mm, preserveAspectRatio=True)
+    stamp = get_image_reader(STAMP_PATH)
+    if stamp is not None:
+        c.drawImage(stamp, margin, 20*mm, width=40*mm, preserveAspectRatio=True)
 
     # Nom de l'hôpital à droite
     c.setFont('Helvetica-Bold', 10)
@@ -242,12 +374,28 @@ def generate_pdf(data, hospital_name, hospital_address):
     
     c.save()
 # ----------------- Enregistrement dans la base -----------------
+def load_base_keys():
+    """Charge les couples (Matricule, Date d'admission) déjà enregistrés, pour éviter les doublons."""
+    keys = set()
     try:
+        frames = []
         if os.path.exists(BASE_FILE):
-            base_df = pd.read_excel(BASE_FILE, engine='openpyxl')
-        else:
-            base_df = pd.DataFrame(columns=BASE_COLUMNS + ['Hôpital', "Date d'enregistrement"])
-        
+            frames.append(pd.read_excel(BASE_FILE, engine='openpyxl', dtype=str))
+        if os.path.exists(BASE_CSV):
+            frames.append(pd.read_csv(BASE_CSV, dtype=str, keep_default_na=False, encoding='utf-8'))
+        for frame in frames:
+            frame = frame.reindex(columns=BASE_KEY_COLUMNS).fillna('')
+            keys.update(zip(frame['Matricule'], frame['Date d\'admission']))
+    except Exception as e:
+        print(f"Erreur lors du chargement de la base: {e}")
+    return keys
+
+def save_to_base(data, hospital_name, known_keys):
+    """
+    Ajoute la lettre au fichier CSV d'ajout (une ligne, sans réécrire la base).
+    `known_keys` est l'ensemble renvoyé par load_base_keys, mis à jour en place.
+    """
+    try:
         data_to_save = {
             'Matricule': data.get('Matricule',''),
             'Nom & Prénom': f"{data.get('Nom','')} {data.get('Prénom','')}".strip(),
@@ -260,15 +408,42 @@ def generate_pdf(data, hospital_name, hospital_address):
         }
 
         # Évite les doublons
-        if not ((base_df['Matricule'] == data_to_save['Matricule']) &
-                (base_df['Date d\'admission'] == data_to_save['Date d\'admission'])).any():
-            base_df = pd.concat([base_df, pd.DataFrame([data_to_save])], ignore_index=True)
-            base_df.to_excel(BASE_FILE, index=False, engine='openpyxl')
+        key = (data_to_save['Matricule'], data_to_save['Date d\'admission'])
+        if key not in known_keys:
+            pd.DataFrame([data_to_save]).to_csv(BASE_CSV, mode='a', header=not os.path.exists(BASE_CSV),
+                                                index=False, encoding='utf-8')
+            known_keys.add(key)
         else:
             print("Formulaire déjà enregistré dans la base.")
     except Exception as e:
         print(f"Erreur lors de l'enregistrement dans la base: {e}")
+
+def export_base():
+    """Fusionne les lignes du fichier CSV d'ajout dans le classeur Excel de la base."""
+    frames = []
+    if os.path.exists(BASE_FILE):
+        frames.append(pd.read_excel(BASE_FILE, engine='openpyxl', dtype=str))
+    if os.path.exists(BASE_CSV):
+        frames.append(pd.read_csv(BASE_CSV, dtype=str, keep_default_na=False, encoding='utf-8'))
+    if frames:
+        base_df = pd.concat(frames, ignore_index=True).drop_duplicates(subset=BASE_KEY_COLUMNS)
+    else:
+        base_df = pd.DataFrame(columns=BASE_COLUMNS + ['Hôpital', "Date d'enregistrement"])
+    base_df.to_excel(BASE_FILE, index=False, engine='openpyxl')
+    # Les lignes sont maintenant dans le classeur
+    if os.path.exists(BASE_CSV):
+        os.remove(BASE_CSV)
+    return len(base_df)
+
 # ----------------- Tkinter App -----------------
+@functools.lru_cache(maxsize=None)
+def load_logo_thumbnail(path, size=(150, 150)):
+    """Décode et réduit le logo de l'interface une seule fois par processus (None si absent)."""
+    if not os.path.exists(path):
+        return None
+    img = Image.open(path)
+    img.thumbnail(size)
+    return img
 
 class App:
     def __init__(self, master):
@@ -278,14 +453,14 @@ class App:
         except Exception as e:
             messagebox.showerror('Erreur', str(e))
             self.df = pd.DataFrame(columns=['Matricule','Nom','Prénom','CIN','CNSS'])
+        self._build_search_index()
+        self._base_keys = load_base_keys()
 
-        # --- Helper to remove accents ---
-        def remove_accents(input_str):
-            return ''.join(
-                c for c in unicodedata.normalize('NFD', input_str)
-                if unicodedata.category(c) != 'Mn'
-            )
-        self.remove_accents = remove_accents
+        # --- Aperçu : document PyMuPDF réutilisé (créé au premier rendu) et rendu différé ---
+        self._preview_doc = None
+        self._preview_pending = None
+        self._last_preview_key = None
+        self._suspend_preview = False
 
         # --- Variables ---
         self.hopital_var = StringVar(value=list(HOSPITAUX.keys())[0]) 
@@ -301,7 +476,7 @@ class App:
         for var in [self.hopital_var, self.matricule_var, self.nom_prenom_var,
                     self.cin_var, self.cnss_var, self.medecin_r_var, self.medecin_t_var,
                     self.date_var, self.type_var]:
-            var.trace_add('write', lambda *args: self.update_preview())
+            var.trace_add('write', lambda *args: self._schedule_preview())
 
         # --- UI Layout ---
         left = Frame(master)
@@ -309,10 +484,10 @@ class App:
         right = Frame(master)
         right.pack(side=RIGHT, fill=BOTH, expand=True, padx=10, pady=10)
 
-        if os.path.exists(LOGO):
-            img = Image.open(LOGO)
-            img.thumbnail((150,150))
-            self.logo_img = ImageTk.PhotoImage(img)
+        logo = load_logo_thumbnail(LOGO)
+        if logo is not None:
+            from PIL import ImageTk
+            self.logo_img = ImageTk.PhotoImage(logo)
             Label(left, image=self.logo_img).pack(anchor='ne')
 
         Label(left, text="Lieu d'admission :").pack()
@@ -328,6 +503,7 @@ class App:
         Button(frame_matricule, text="🔍", command=self.search_by_matricule,
             font=('Helvetica', 14), padx=10).pack(side=RIGHT, ipady=2)
         self.listbox_window_matricule = None
+        self.listbox_matricule = None
 
         # Name search with autocomplete
         Label(left, text="Nom & Prénom").pack(anchor='w', pady=(6,0))
@@ -339,6 +515,7 @@ class App:
         Button(frame_nom, text="🔍", command=self.search_by_name,
             font=('Helvetica', 14), padx=10).pack(side=RIGHT, ipady=2)
         self.listbox_window_name = None
+        self.listbox_name = None
 
         # Other fields
         for label, var in [
@@ -361,6 +538,9 @@ class App:
         Button(buttons_frame, text="Effacer Formulaire", command=self.clear_form, font=('Helvetica', 12), padx=10, pady=5).pack(
             side=LEFT, expand=True, fill=X, padx=5
         )
+        Button(buttons_frame, text="Exporter Base", command=self.export, font=('Helvetica', 12), padx=10, pady=5).pack(
+            side=LEFT, expand=True, fill=X, padx=5
+        )
 
         # Preview
         Label(right, text='Aperçu PDF:').pack()
@@ -368,12 +548,31 @@ class App:
         self.preview_label.pack()
 
     # ----------------- Search Methods -----------------
+    def _build_search_index(self):
+        """Précalcule NomComplet et les index de recherche (une seule fois après chargement)."""
+        self.df['NomComplet'] = normalize_name_column(
+            self.df['Nom'].fillna('').astype(str) + ' ' + self.df['Prénom'].fillna('').astype(str)
+        )
+        self._matricules_str = self.df['Matricule'].astype(str)
+        noms = self.df['NomComplet']
+        # Premier employé rencontré pour chaque matricule / nom -> index du DataFrame
+        first = ~self._matricules_str.duplicated()
+        self._mat_index = dict(zip(self._matricules_str[first], self.df.index[first]))
+        first = ~noms.duplicated()
+        self._nom_index = dict(zip(noms[first], self.df.index[first]))
+        # Listes triées pour l'autocomplétion par préfixe (bisect)
+        self._mat_sorted = sorted(self._matricules_str.tolist())
+        self._nom_sorted = sorted(noms.tolist())
+
     def search_by_matricule(self):
         m = self.matricule_var.get().strip()
         if not m:
             messagebox.showinfo('Info', 'Entrez un matricule à rechercher.')
             return
-        row = self.df[self.df['Matricule'].astype(str).str.contains(m, case=False, na=False)]
+        if m in self._mat_index:
+            self.fill_fields(self.df.loc[self._mat_index[m]])
+            return
+        row = self.df[self._matricules_str.str.contains(m, case=False, regex=False, na=False)]
         if row.empty:
             messagebox.showinfo('Résultat', 'Aucun employé trouvé.')
             return
@@ -381,15 +580,14 @@ class App:
 
     def search_by_name(self):
         input_str = self.nom_prenom_var.get().strip()
+        # Même syntaxe que l'autocomplétion : un '*' en tête est ignoré
+        if input_str.startswith('*'):
+            input_str = input_str[1:].strip()
         if not input_str:
             messagebox.showinfo('Info', 'Entrez Nom et/ou Prénom.')
             return
-        input_norm = self.remove_accents(input_str.lower())
-        self.df['NomComplet'] = self.df.apply(
-            lambda row: self.remove_accents(f"{row['Nom']} {row['Prénom']}".lower().strip()),
-            axis=1
-        )
-        mask = self.df['NomComplet'].str.contains(input_norm, na=False)
+        input_norm = normalize_name(input_str)
+        mask = self.df['NomComplet'].str.contains(input_norm, regex=False, na=False)
         row = self.df[mask]
         if row.empty:
             messagebox.showinfo('Résultat', 'Aucun employé trouvé.')
@@ -397,98 +595,104 @@ class App:
         self.fill_fields(row.iloc[0])
 
     def fill_fields(self, row):
-        self.matricule_var.set(str(row.get('Matricule','')).strip())
-        self.nom_prenom_var.set(f"{row.get('Nom','').strip()} {row.get('Prénom','').strip()}")
-        self.cin_var.set(format_cin(row.get('CIN','')))
-        self.cnss_var.set(str(row.get('CNSS','')).strip())
-        self.update_preview()
+        self._suspend_preview = True
+        try:
+            self.matricule_var.set(str(row.get('Matricule','')).strip())
+            self.nom_prenom_var.set(f"{row.get('Nom','').strip()} {row.get('Prénom','').strip()}")
+            self.cin_var.set(format_cin(row.get('CIN','')))
+            self.cnss_var.set(str(row.get('CNSS','')).strip())
+        finally:
+            self._suspend_preview = False
+        self._schedule_preview()
 
     # ----------------- Autocomplete Methods -----------------
+    def _create_autocomplete(self, width, on_select):
+        """Crée (une seule fois) la fenêtre d'autocomplétion, cachée, et sa Listbox."""
+        window = Toplevel(self.master)
+        window.overrideredirect(True)
+        window.withdraw()
+        listbox = Listbox(window, width=width)
+        listbox.pack()
+        listbox.bind("<<ListboxSelect>>", lambda e: on_select(listbox))
+        return window, listbox
+
+    def _show_autocomplete(self, window, listbox, entry, matches):
+        """Recharge la Listbox sous le champ `entry`, ou cache la fenêtre s'il n'y a rien à proposer."""
+        listbox.delete(0, 'end')
+        if not matches:
+            window.withdraw()
+            return
+        listbox.insert('end', *matches)
+        x = entry.winfo_rootx()
+        y = entry.winfo_rooty() + entry.winfo_height()
+        window.geometry(f"+{x}+{y}")
+        window.deiconify()
+
     def on_name_typing(self, event):
         text = self.nom_prenom_var.get().strip().lower()
         if not text:
             if self.listbox_window_name:
-                self.listbox_window_name.destroy()
+                self.listbox_window_name.withdraw()
             return
 
-        self.df['NomComplet'] = self.df.apply(
-            lambda row: self.remove_accents(f"{row['Nom']} {row['Prénom']}".lower().strip()),
-            axis=1
-        )
-        input_norm = self.remove_accents(text)
-        matches = self.df[self.df['NomComplet'].str.contains(input_norm, na=False)]['NomComplet'].tolist()
-
-        if matches:
-            if self.listbox_window_name:
-                self.listbox_window_name.destroy()
-            self.listbox_window_name = Toplevel(self.master)
-            self.listbox_window_name.overrideredirect(True)
-            x = self.nom_entry.winfo_rootx()
-            y = self.nom_entry.winfo_rooty() + self.nom_entry.winfo_height()
-            self.listbox_window_name.geometry(f"+{x}+{y}")
-
-            listbox = Listbox(self.listbox_window_name, width=40)
-            listbox.pack()
-            for match in matches:
-                listbox.insert('end', match)
-
-            listbox.bind("<<ListboxSelect>>", lambda e: self.select_autocomplete_name(listbox))
+        # Recherche par préfixe ; un '*' en tête recherche n'importe où dans le nom
+        if text.startswith('*'):
+            input_norm = normalize_name(text[1:])
+            mask = self.df['NomComplet'].str.contains(input_norm, regex=False, na=False)
+            matches = self.df.loc[mask, 'NomComplet'].head(20).tolist()
         else:
-            if self.listbox_window_name:
-                self.listbox_window_name.destroy()
+            matches = prefix_matches(self._nom_sorted, normalize_name(text))
+
+        if not self.listbox_window_name:
+            self.listbox_window_name, self.listbox_name = self._create_autocomplete(40, self.select_autocomplete_name)
+        self._show_autocomplete(self.listbox_window_name, self.listbox_name, self.nom_entry, matches)
 
     def select_autocomplete_name(self, listbox):
+        if not listbox.curselection():
+            return
         selection = listbox.get(listbox.curselection())
         self.nom_prenom_var.set(selection)
         if self.listbox_window_name:
-            self.listbox_window_name.destroy()
-        row = self.df[self.df['NomComplet'] == self.remove_accents(selection.lower())]
-        if not row.empty:
-            self.fill_fields(row.iloc[0])
+            self.listbox_window_name.withdraw()
+        key = normalize_name(selection)
+        if key in self._nom_index:
+            self.fill_fields(self.df.loc[self._nom_index[key]])
 
     def on_matricule_typing(self, event):
-        text = self.matricule_var.get().strip().lower()
+        text = self.matricule_var.get().strip()
         if not text:
             if self.listbox_window_matricule:
-                self.listbox_window_matricule.destroy()
+                self.listbox_window_matricule.withdraw()
             return
-        matches = self.df[self.df['Matricule'].astype(str).str.lower().str.contains(text, na=False)]['Matricule'].tolist()
+        matches = prefix_matches(self._mat_sorted, text)
 
-        if matches:
-            if self.listbox_window_matricule:
-                self.listbox_window_matricule.destroy()
-            self.listbox_window_matricule = Toplevel(self.master)
-            self.listbox_window_matricule.overrideredirect(True)
-            x = self.matricule_entry.winfo_rootx()
-            y = self.matricule_entry.winfo_rooty() + self.matricule_entry.winfo_height()
-            self.listbox_window_matricule.geometry(f"+{x}+{y}")
-
-            listbox = Listbox(self.listbox_window_matricule, width=20)
-            listbox.pack()
-            for match in matches:
-                listbox.insert('end', match)
-
-            listbox.bind("<<ListboxSelect>>", lambda e: self.select_autocomplete_matricule(listbox))
-        else:
-            if self.listbox_window_matricule:
-                self.listbox_window_matricule.destroy()
+        if not self.listbox_window_matricule:
+            self.listbox_window_matricule, self.listbox_matricule = self._create_autocomplete(20, self.select_autocomplete_matricule)
+        self._show_autocomplete(self.listbox_window_matricule, self.listbox_matricule, self.matricule_entry, matches)
 
     def select_autocomplete_matricule(self, listbox):
+        if not listbox.curselection():
+            return
         selection = listbox.get(listbox.curselection())
         self.matricule_var.set(selection)
         if self.listbox_window_matricule:
-            self.listbox_window_matricule.destroy()
-        row = self.df[self.df['Matricule'].astype(str) == selection]
-        if not row.empty:
-            self.fill_fields(row.iloc[0])
+            self.listbox_window_matricule.withdraw()
+        if selection in self._mat_index:
+            self.fill_fields(self.df.loc[self._mat_index[selection]])
 
 
     # --------- Génération PDF ---------
+    def _split_nom_prenom(self, s):
+        """Sépare 'Nom Prénom' au premier espace : (nom, reste du texte)."""
+        parts = s.strip().split(None, 1)
+        return (parts[0] if parts else '', parts[1] if len(parts) > 1 else '')
+
     def generate(self):
+        nom, prenom = self._split_nom_prenom(self.nom_prenom_var.get())
         data = {
             'Matricule': self.matricule_var.get().strip(),
-            'Nom': self.nom_prenom_var.get().strip().split()[0] if self.nom_prenom_var.get().strip() else '',
-            'Prénom': self.nom_prenom_var.get().strip().split()[1] if len(self.nom_prenom_var.get().strip().split())>1 else '',
+            'Nom': nom,
+            'Prénom': prenom,
             'CIN': format_cin(self.cin_var.get()),
             'CNSS': self.cnss_var.get().strip(),
             'MedecinRequerant': self.medecin_r_var.get().strip(),
@@ -499,24 +703,45 @@ class App:
         hopital = self.hopital_var.get()
         adresse = HOSPITAUX[hopital]
         generate_pdf(data, hopital, adresse)
+        save_to_base(data, hopital, self._base_keys)
         messagebox.showinfo('Succès', f'PDF généré: {OUTPUT_PDF}')
-        self.update_preview()
+        self._schedule_preview()
+
+    # --------- Export de la base ---------
+    def export(self):
+        try:
+            count = export_base()
+        except Exception as e:
+            messagebox.showerror('Erreur', f"Erreur lors de l'export de la base: {e}")
+            return
+        messagebox.showinfo('Succès', f'Base exportée: {BASE_FILE} ({count} lignes)')
 
     # --------- Effacer formulaire ---------
     def clear_form(self):
-        for var in [self.matricule_var, self.nom_prenom_var, self.cin_var, self.cnss_var,
-                    self.medecin_r_var, self.medecin_t_var, self.date_var, self.type_var]:
-            var.set('')
-        self.hopital_var.set(list(HOSPITAUX.keys())[0])
-        self.update_preview()
+        self._suspend_preview = True
+        try:
+            for var in [self.matricule_var, self.nom_prenom_var, self.cin_var, self.cnss_var,
+                        self.medecin_r_var, self.medecin_t_var, self.date_var, self.type_var]:
+                var.set('')
+            self.hopital_var.set(list(HOSPITAUX.keys())[0])
+        finally:
+            self._suspend_preview = False
+        self._schedule_preview()
+
+    def _schedule_preview(self):
+        """Planifie le rendu de l'aperçu ; les appels rapprochés sont regroupés en un seul."""
+        if self._suspend_preview:
+            return
+        if self._preview_pending is not None:
+            self.master.after_cancel(self._preview_pending)
+        self._preview_pending = self.master.after(120, self.update_preview)
 
     def update_preview(self):
+        self._preview_pending = None
         try:
             # Récupération des données
             matricule = self.matricule_var.get().strip()
-            nom_prenom = self.nom_prenom_var.get().strip().split()
-            nom = nom_prenom[0] if nom_prenom else ''
-            prenom = nom_prenom[1] if len(nom_prenom) > 1 else ''
+            nom, prenom = self._split_nom_prenom(self.nom_prenom_var.get())
             data = {
                 'Matricule': matricule,
                 'Nom': nom,
@@ -532,8 +757,25 @@ class App:
             hopital = self.hopital_var.get()
             adresse = HOSPITAUX[hopital]
 
-            # Création du PDF en mémoire
-            doc = fitz.open()
+            # Rien n'a changé depuis le dernier rendu (ex. var.set() avec la même valeur)
+            key = (*data.values(), hopital)
+            if key == self._last_preview_key:
+                return
+
+            fitz = _get_fitz()
+            from PIL import ImageTk
+
+            # Page unique du document en mémoire, recréée à chaque rendu
+            # Les pages supprimées laissent leurs objets dans le document :
+            # on repart d'un document neuf au-delà d'une taille limite.
+            if self._preview_doc is not None and self._preview_doc.xref_length() > PREVIEW_MAX_XREFS:
+                self._preview_doc.close()
+                self._preview_doc = None
+            if self._preview_doc is None:
+                self._preview_doc = fitz.open()
+            doc = self._preview_doc
+            if doc.page_count:
+                doc.delete_page(0)
             page = doc.new_page()
             
             text = f"""
@@ -569,16 +811,18 @@ La facture du {hopital} est à régler totalement par {ENTREPRISE_INFO['name']}.
 
             # Convertir en image pour Tkinter
             pix = page.get_pixmap()
-            img_data = pix.tobytes("ppm")
-            img = Image.open(io.BytesIO(img_data))
+            img = Image.frombuffer('RGB', (pix.width, pix.height), pix.samples, 'raw', 'RGB', pix.stride, 1)
             img.thumbnail((450, 600))
             self.preview_image = ImageTk.PhotoImage(img)
             self.preview_label.config(image=self.preview_image, text='')
+            self._last_preview_key = key
         except Exception as e:
+            self._last_preview_key = None
             self.preview_label.config(text=f"Aperçu indisponible: {e}", image='')
 
 # --------- Lancement ---------
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
     root = Tk()
     root.geometry('1000x700')
     root.title('Générateur Lettre de Liaison - CF MAIER ITAP')